@@ -1,12 +1,30 @@
+import os
+import sys
+
 import pytest
+from tokenize_rt import tokens_to_src
 
-from un_fstring import convert_f_strings_to_strings_format
+import un_fstring
+from un_fstring import (
+    ConversionFailed,
+    convert_f_string_to_format_string,
+    convert_f_strings,
+    convert_f_strings_to_strings_format,
+    convert_file,
+    diff,
+    gather_files,
+    is_f_string_start,
+    might_contain_f_strings,
+    read_ahead,
+    string_runs,
+)
 
 
 @pytest.mark.parametrize(
     "input, expected",
     [
         ('f"{foobar}"', "'{}'.format(foobar)"),
+        ("f'{foo.bar}'", "'{}'.format(foo.bar)"),
         ('f"{foobar!a}"', "'{!a}'.format(foobar)"),
         ('f"{foobar:20}"', "'{:20}'.format(foobar)"),
         ('f"{foobar!a:20}"', "'{!a:20}'.format(foobar)"),
@@ -14,7 +32,175 @@ from un_fstring import convert_f_strings_to_strings_format
         ('f"{[x for x in range(1)]}"', "'{}'.format([x for x in range(1)])"),
         ('f"hello {a} goodbye {b}"', "'hello {} goodbye {}'.format(a, b)"),
         ('f"hello {a!r:20} goodbye {b!a}"', "'hello {!r:20} goodbye {!a}'.format(a, b)"),
+        ('f"{foobar:{width}.{precision}}"', "'{:{}.{}}'.format(foobar, width, precision)"),
+        ('f"{{foobar}} {baz}"', "'{{foobar}} {}'.format(baz)"),
+        ('f"it\'s {foobar}"', '"it\'s {}".format(foobar)'),
+        ('F"{foobar}"', "'{}'.format(foobar)"),
+        ('Rf"{foobar}"', "'{}'.format(foobar)"),
+        ('fR"{foobar}"', "'{}'.format(foobar)"),
+        ('(rb"{foobar}", f"{baz}")', "(rb\"{foobar}\", '{}'.format(baz))"),
+        ('"{}" f"{a}"', "'{{}}{}'.format(a)"),
+        ('f"{a}" f"{b}"', "'{}{}'.format(a, b)"),
+        ('"{}" f"{a}".upper()', "'{{}}{}'.format(a).upper()"),
+        ('(f"{a}"  # comment\n "b")', "('{}b'.format(a)  # comment\n)"),
+        ('(f"{a}"  # one\n  # two\n "b")', "('{}b'.format(a)  # one\n  # two\n)"),
+        ('x = "a" \\\n    f"{b}"\ny = 1', "x = 'a{}'.format(b)\ny = 1"),
+        ('x = "a" \\\n    f"{b}"', "x = 'a{}'.format(b)"),
+        ('x = f"{a}" \\\n  "b" \\\n  "c"\ny = 2\n', "x = '{}bc'.format(a)\ny = 2\n"),
+        ('foo("a"\n    f"{b}",\n    c)', "foo('a{}'.format(b),\n    c)"),
     ],
 )
 def test_conversion(input, expected):
-    assert convert_f_strings_to_strings_format(input) == expected
+    output = convert_f_strings_to_strings_format(input)
+
+    assert output == expected
+    compile(output, "<un-fstring>", "exec")
+
+
+def test_convert_file_runs_every_conversion(tmp_path):
+    file = tmp_path / "foo.py"
+    file.write_text('print(f"{foo}", f"{bar}")\n')
+
+    def convert_first_f_string(parsed):
+        tokens = parsed.tokens
+        for run in string_runs(tokens):
+            [(start, end)] = run
+            if is_f_string_start(tokens[start]):
+                src = convert_f_string_to_format_string(tokens_to_src(tokens[start : end + 1]))
+                tokens[start : end + 1] = [tokens[start]._replace(src=src)]
+                parsed.dirty = True
+                break
+
+        return parsed
+
+    assert convert_file(
+        file, conversions=[convert_first_f_string, convert_first_f_string], dry_run=False
+    )
+    assert file.read_text() == "print('{}'.format(foo), '{}'.format(bar))\n"
+
+
+@pytest.mark.parametrize(
+    "src, expected",
+    [
+        ('f"{foo}"', True),
+        ("F'{foo}'", True),
+        ('rf"{foo}"', True),
+        ('fR"{foo}"', True),
+        ('"{}".format(foo)', False),
+        ("if foo: pass", False),
+    ],
+)
+def test_might_contain_f_strings(src, expected):
+    assert might_contain_f_strings(src) is expected
+
+
+def test_convert_file_dry_run_prints_diff(tmp_path, capsys):
+    file = tmp_path / "foo.py"
+    file.write_text('print(f"{foo}")\n')
+
+    assert convert_file(file, conversions=[convert_f_strings], dry_run=True)
+    assert file.read_text() == 'print(f"{foo}")\n'
+    assert capsys.readouterr().out.splitlines()[2:] == [
+        "@@ -1 +1 @@",
+        '-print(f"{foo}")',
+        "+print('{}'.format(foo))",
+    ]
+
+
+def test_gather_files(tmp_path):
+    (tmp_path / "a.py").touch()
+    (tmp_path / "b.txt").touch()
+    (tmp_path / "pkg" / "sub").mkdir(parents=True)
+    (tmp_path / "pkg" / "c.py").touch()
+    (tmp_path / "pkg" / "sub" / "d.py").touch()
+    (tmp_path / "dir.py").mkdir()
+    (tmp_path / "dir.py" / "e.py").touch()
+    (tmp_path / ".git" / "hooks").mkdir(parents=True)
+    (tmp_path / ".git" / "hooks" / "hook.py").touch()
+    (tmp_path / ".#a.py").symlink_to(tmp_path / "does-not-exist")
+    single = tmp_path / "pkg" / "c.py"
+
+    assert sorted(gather_files([tmp_path, single])) == sorted(
+        [
+            tmp_path / "a.py",
+            tmp_path / "pkg" / "c.py",
+            tmp_path / "pkg" / "sub" / "d.py",
+            tmp_path / "dir.py" / "e.py",
+            single,
+        ]
+    )
+
+
+def test_convert_file_preserves_line_endings(tmp_path):
+    file = tmp_path / "foo.py"
+    file.write_bytes(b'foo = 1\r\nprint(f"{foo}")\r\n')
+
+    assert convert_file(file, conversions=[convert_f_strings], dry_run=False)
+    assert file.read_bytes() == b"foo = 1\r\nprint('{}'.format(foo))\r\n"
+
+
+def test_read_ahead(tmp_path):
+    files = [tmp_path / f"{n}.py" for n in range(5)]
+    for file in files:
+        file.write_text(file.stem)
+
+    assert list(read_ahead(files)) == [(file, file.stem.encode()) for file in files]
+
+
+def test_cli_parallel_dry_run_output_is_in_file_order(tmp_path, monkeypatch, capsys):
+    files = [tmp_path / f"{n:02}.py" for n in range(20)]
+    for n, file in enumerate(files):
+        file.write_text("".join(f'x{i} = f"{{a}}{n}"\n' for i in range(200)))
+
+    monkeypatch.setattr(sys, "argv", ["un-fstring", "--dry-run", str(tmp_path)])
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    monkeypatch.setattr(un_fstring, "FILES_PER_TASK", 2)
+
+    assert un_fstring.cli() == 1
+
+    expected = ""
+    for file in gather_files([tmp_path]):
+        src = file.read_text()
+        mod = convert_f_strings_to_strings_format(src)
+        expected += "".join(diff(src.splitlines(True), mod.splitlines(True), file))
+
+    assert capsys.readouterr().out == expected + "Checked 20 files; would have modified 20 files\n"
+
+
+def test_convert_file_dry_run_diff_without_final_newline(tmp_path, capsys):
+    file = tmp_path / "foo.py"
+    file.write_text('print(f"{foo}")')
+
+    assert convert_file(file, conversions=[convert_f_strings], dry_run=True)
+    assert capsys.readouterr().out.splitlines()[2:] == [
+        "@@ -1 +1 @@",
+        '-print(f"{foo}")',
+        "\\ No newline at end of file",
+        "+print('{}'.format(foo))",
+        "\\ No newline at end of file",
+    ]
+
+
+def test_cli_parallel_reports_modified_files_when_one_fails(tmp_path, monkeypatch, capsys):
+    files = [tmp_path / f"{n:02}.py" for n in range(12)]
+    for file in files:
+        file.write_text("x = f'{y}'\n")
+    files[5].write_bytes(b"x = f'\xff{y}'\n")
+
+    monkeypatch.setattr(sys, "argv", ["un-fstring", str(tmp_path)])
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    monkeypatch.setattr(un_fstring, "FILES_PER_TASK", 2)
+
+    with pytest.raises(ConversionFailed) as exc_info:
+        un_fstring.cli()
+
+    assert exc_info.value.file == files[5]
+
+    reported = capsys.readouterr().out.splitlines()
+    rewritten = [
+        f"Modified {file}"
+        for file in gather_files([tmp_path])
+        if "format" in file.read_text("latin-1")
+    ]
+    assert rewritten
+    assert reported == rewritten
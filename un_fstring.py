@@ -3,26 +3,88 @@
 import argparse
 import ast
 import difflib
+import functools
+import io
 import os
+import re
 import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, TextIO, Tuple, cast
 
-import astroid
-from tokenize_rt import Offset, Token, src_to_tokens, tokens_to_src
+from tokenize_rt import Token, src_to_tokens, tokens_to_src
 
-WINDOWS = os.name == "nt"
+# Below this many files, it's faster to convert them serially
+# than to pay the cost of starting up worker processes.
+MIN_FILES_FOR_PARALLEL = 4
 
+# How many files each worker process converts per task.
+FILES_PER_TASK = 16
 
-class FindFStrings(ast.NodeVisitor):
-    def __init__(self) -> None:
-        self.fstrings: Dict[Offset, ast.JoinedStr] = {}
+# How many files to read ahead of the one being converted.
+READ_AHEAD = 2
 
-    def visit_JoinedStr(self, node: ast.JoinedStr) -> None:
-        offset = Offset(node.lineno, node.col_offset)
-        self.fstrings[offset] = node
+# Matches the opening of any f-string (including raw f-strings),
+# but also plenty of things that aren't f-strings (like the end of "elif'").
+# It's only used to cheaply rule out sources that can't have any f-strings in them.
+MAYBE_F_STRING = re.compile(r"[fF][rR]?['\"]")
 
-        self.generic_visit(node)
+# Matches the prefix of a string token that is an f-string, in any case and order.
+F_STRING_PREFIX = re.compile(r"[fF][rR]?|[rR][fF]")
+
+# Matches the most common kind of f-string, which just interpolates a name
+# or attribute lookup with no conversion or format spec, like f"{self.name}".
+TRIVIAL_F_STRING = re.compile(r"[fF](['\"])\{([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)\}\1")
+
+# Tokens that can sit between implicitly concatenated string literals.
+CONCATENATION_FILLER = frozenset({"UNIMPORTANT_WS", "NL", "COMMENT", "ESCAPED_NL"})
+
+# Directories that never hold source code worth converting,
+# and which can be large (especially version control metadata).
+SKIP_DIRECTORIES = frozenset({".git", ".hg", ".svn", "__pycache__"})
+
+
+@dataclass
+class ParsedSource:
+    """
+    Source code that is threaded through a pipeline of conversions,
+    along with its token stream,
+    so that each conversion doesn't have to re-tokenize it.
+
+    A conversion that modifies ``tokens`` should set ``dirty``,
+    which marks ``src`` as stale.
+    """
+
+    src: str
+    tokens: List[Token]
+    dirty: bool = False
+
+    @classmethod
+    def from_src(cls, src: str) -> "ParsedSource":
+        return cls(src=src, tokens=src_to_tokens(src))
+
+    def refresh(self) -> "ParsedSource":
+        """
+        Bring ``src`` back in sync with ``tokens`` (and re-tokenize it,
+        since modified tokens may not be single tokens anymore), if it is stale.
+        """
+        if self.dirty:
+            self.src = tokens_to_src(self.tokens)
+            self.tokens = src_to_tokens(self.src)
+            self.dirty = False
+
+        return self
+
+    def to_src(self) -> str:
+        """
+        Get the (possibly modified) source code, without re-tokenizing it.
+        """
+        return tokens_to_src(self.tokens) if self.dirty else self.src
+
+
+Conversion = Callable[[ParsedSource], ParsedSource]
 
 
 def convert_f_strings_to_strings_format(src: str) -> str:
@@ -30,77 +92,175 @@ def convert_f_strings_to_strings_format(src: str) -> str:
     Convert all f-string in arbitrary source code to .format() calls,
     returning the full modified source code.
     """
-    ast_ = ast.parse(src)
+    if not might_contain_f_strings(src):
+        return src
 
-    visitor = FindFStrings()
-    visitor.visit(ast_)
+    return convert_f_strings(ParsedSource.from_src(src)).to_src()
 
-    tokens = src_to_tokens(src)
 
-    for idx, token in enumerate(tokens):
-        if token.offset in visitor.fstrings and token.src.startswith("f"):
-            tokens[idx] = Token(
-                name=token.name,
-                src=convert_f_string_to_format_string(token.src),
-                line=token.line,
-                utf8_byte_offset=token.utf8_byte_offset,
-            )
+def might_contain_f_strings(src: str) -> bool:
+    """
+    Cheaply check whether source code could possibly contain an f-string,
+    so that sources that definitely don't can skip parsing entirely.
+    """
+    return MAYBE_F_STRING.search(src) is not None
 
-    return tokens_to_src(tokens)
+
+def convert_f_strings(parsed: ParsedSource) -> ParsedSource:
+    """
+    Convert all f-strings in parsed source code to .format() calls.
+    This is the conversion run by the command line tool.
+    """
+    tokens = parsed.tokens
+
+    # F-strings can be found from the tokens alone, so there's no need to parse the
+    # whole file to find them; each one is parsed on its own when it's converted.
+    for run in string_runs(tokens):
+        if not any(is_f_string_start(tokens[start]) for start, _ in run):
+            continue
+
+        # Python joins implicitly concatenated literals before anything else happens
+        # (like a .format() call on them), so the whole run has to become one call.
+        # The call takes the place of the literals and everything between them,
+        # except comments (and the whitespace before and line break after each comment).
+        first, last = run[0][0], run[-1][1]
+        src = " ".join(tokens_to_src(tokens[start : end + 1]) for start, end in run)
+        literal_indices = {idx for start, end in run for idx in range(start, end + 1)}
+        for idx in range(first, last + 1):
+            token = tokens[idx]
+            if idx in literal_indices or not (
+                token.name == "COMMENT"
+                or (token.name == "UNIMPORTANT_WS" and tokens[idx + 1].name == "COMMENT")
+                or (token.name == "NL" and tokens[idx - 1].name == "COMMENT")
+            ):
+                tokens[idx] = token._replace(src="")
+
+        tokens[first] = tokens[first]._replace(src=convert_f_string_to_format_string(src))
+
+        parsed.dirty = True
+
+    return parsed
+
+
+def string_runs(tokens: List[Token]) -> Iterator[List[Tuple[int, int]]]:
+    """
+    Yield each run of implicitly concatenated string literals
+    (a lone string literal is a run of one),
+    as the (inclusive) spans of token indices that make up each literal.
+
+    Before Python 3.12, every literal is a single STRING token.
+    Since Python 3.12, an f-string is all the tokens from an FSTRING_START
+    to its matching FSTRING_END (which may have other f-strings nested inside).
+    """
+    run: List[Tuple[int, int]] = []
+    idx = 0
+    while idx < len(tokens):
+        name = tokens[idx].name
+        if name == "STRING":
+            run.append((idx, idx))
+        elif name == "FSTRING_START":
+            start, depth = idx, 1
+            while depth:
+                idx += 1
+                if tokens[idx].name == "FSTRING_START":
+                    depth += 1
+                elif tokens[idx].name == "FSTRING_END":
+                    depth -= 1
+            run.append((start, idx))
+        elif name not in CONCATENATION_FILLER and run:
+            yield run
+            run = []
+
+        idx += 1
+
+    if run:
+        yield run
+
+
+def is_f_string_start(token: Token) -> bool:
+    """
+    Check whether a token is the first (or only) token of an f-string.
+    """
+    return token.name == "FSTRING_START" or (
+        token.name == "STRING" and F_STRING_PREFIX.match(token.src) is not None
+    )
 
 
 CONVERSIONS = {-1: "", 115: "!s", 114: "!r", 97: "!a"}
 
 
+@functools.lru_cache(maxsize=8192)
 def convert_f_string_to_format_string(src: str) -> str:
     """
-    Convert a single f-string (passed as its source token)
+    Convert a single f-string (passed as the source of its string literals,
+    which may be several implicitly concatenated ones)
     to a .format() call (as a source token).
+
+    The same f-strings tend to show up over and over again,
+    so conversions are cached (per process).
     """
-    node = astroid.extract_node(src)
+    # Trivial f-strings don't need to be parsed at all
+    trivial = TRIVIAL_F_STRING.fullmatch(src)
+    if trivial is not None:
+        return "'{}'.format(" + trivial.group(2) + ")"
+
+    node = cast(ast.JoinedStr, ast.parse(src, mode="eval").body)
+
+    format_args: List[ast.expr] = []
+    format_string = build_format_string(node, format_args)
+
+    # The shape of the call is always the same, so there's no need to build
+    # (and then unparse) a whole Call node; only the arguments need unparsing.
+    # repr picks whichever quotes the format string needs.
+    return "{}.format({})".format(
+        repr(format_string), ", ".join(ast.unparse(arg) for arg in format_args)
+    )
 
-    # An f-string alternates between two kinds of nodes: string Const nodes and
+
+def build_format_string(node: ast.JoinedStr, format_args: List[ast.expr]) -> str:
+    """
+    Build the format string equivalent to an f-string,
+    appending the expressions that it interpolates to ``format_args``
+    in the order that the format string consumes them.
+    """
+    # An f-string alternates between two kinds of nodes: string Constant nodes and
     # FormattedValue nodes that hold the formatting bits
     format_string_parts = []
-    format_args = []
-    for child in node.get_children():
-        if isinstance(child, astroid.Const):
-            format_string_parts.append(child.value)
-        elif isinstance(child, astroid.FormattedValue):
-            format_string_parts.append(
-                "{{{c}{f}}}".format(
-                    c=CONVERSIONS[child.conversion],
-                    f=f":{child.format_spec.values[0].value}"
-                    if child.format_spec is not None
-                    else "",
-                )
-            )
-
+    for child in node.values:
+        if isinstance(child, ast.Constant):
+            format_string_parts.append(cast(str, child.value).replace("{", "{{").replace("}", "}}"))
+        elif isinstance(child, ast.FormattedValue):
             # We can pick the format value nodes right out of the string
             # and place them in the args; no need to introspect what they
             # actually are!
             format_args.append(child.value)
 
-    format_string_node = astroid.Const("".join(format_string_parts))
-
-    format_call = astroid.Call(lineno=node.lineno, col_offset=node.col_offset)
-
-    # The Call's func is a method looked up on the format string
-    format_attr = astroid.Attribute(attrname="format", lineno=node.lineno, parent=format_call)
-    format_attr.postinit(expr=format_string_node)
+            # The format spec is itself an f-string, which may have its own
+            # replacement fields (which are filled in after the value itself)
+            format_spec = (
+                f":{build_format_string(child.format_spec, format_args)}"
+                if isinstance(child.format_spec, ast.JoinedStr)
+                else ""
+            )
 
-    # The Call's arguments are the format arguments extracted from the f-string
-    format_call.postinit(func=format_attr, args=format_args, keywords=[])
+            format_string_parts.append(f"{{{CONVERSIONS[child.conversion]}{format_spec}}}")
 
-    return format_call.as_string()
+    return "".join(format_string_parts)
 
 
-def convert_file(file: Path, conversions: List[Callable[[str], str]], dry_run: bool) -> bool:
+def convert_file(
+    file: Path,
+    conversions: List[Conversion],
+    dry_run: bool,
+    contents: Optional[bytes] = None,
+    out: Optional[TextIO] = None,
+) -> bool:
     """
     Run a list of conversions over a file.
-    Each conversion takes in the file contents
+    Each conversion takes in the parsed file contents
     (possibly modified by a prior conversion)
-    and emits a new version of the file contents.
+    and emits a new version of the parsed file contents.
+    The file is only re-tokenized between conversions if a conversion modified it.
 
     Parameters
     ----------
@@ -112,44 +272,128 @@ def convert_file(file: Path, conversions: List[Callable[[str], str]], dry_run: b
         If ``False``, and the final file contents do not match the original,
         the file will be overwritten with the converted contents.
         If ``True``, instead print a diff showing how the file would change.
+    contents
+        The contents of the file, if they have already been read.
+        If ``None``, the file will be read.
+    out
+        Where to write messages and diffs about the file.
+        If ``None``, they are written to standard output.
 
     Returns
     -------
     was_modified : bool
         ``True`` if the file was/would be modified.
     """
-    mod = src = file.read_text()
+    if contents is None:
+        contents = file.read_bytes()
+
+    if out is None:
+        out = sys.stdout
 
+    # Python source is UTF-8, so skip the text layer (and its newline translation)
+    # and decode the whole file at once.
+    src = contents.decode("utf-8")
+
+    # Every conversion operates on f-strings, so there's nothing to do
+    # (and no need to parse the file) if there can't be any.
+    if not might_contain_f_strings(src):
+        return False
+
+    parsed = ParsedSource.from_src(src)
     for conversion in conversions:
-        mod = conversion(src)
+        parsed = conversion(parsed.refresh())
+
+    mod = parsed.to_src()
 
     was_modified = src != mod
 
     if was_modified and not dry_run:
-        # Atomic overwrite on Linux
-        if WINDOWS:
-            file.write_text(mod)
-        else:
-            tmp_file = file.with_name(file.name + ".tmp")
-            tmp_file.write_text(mod)
-            tmp_file.rename(file)
+        # Atomic overwrite
+        tmp_file = file.with_name(file.name + ".tmp")
+        tmp_file.write_bytes(mod.encode("utf-8"))
+        os.replace(tmp_file, file)
 
-        print(f"Modified {file}")
+        print(f"Modified {file}", file=out)
     elif was_modified and dry_run:
-        print(diff(src, mod, file))
+        out.writelines(diff(src.splitlines(keepends=True), mod.splitlines(keepends=True), file))
 
     return was_modified
 
 
-def diff(a: str, b: str, path: Path) -> str:
-    return "".join(
-        difflib.unified_diff(
-            a.splitlines(keepends=True),
-            b.splitlines(keepends=True),
-            fromfile=str(path),
-            tofile=f"un-fstring({path})",
-        )
-    )
+class ConversionFailed(Exception):
+    """
+    Raised by :func:`convert_files` when converting one of its files fails,
+    carrying the results for the files that were converted before it.
+    """
+
+    def __init__(self, file: Path, results: List[Tuple[bool, str]]) -> None:
+        super().__init__(file, results)
+        self.file = file
+        self.results = results
+
+    def __str__(self) -> str:
+        return f"Failed to convert {self.file}"
+
+
+def convert_files(
+    files: List[Path], conversions: List[Conversion], dry_run: bool
+) -> List[Tuple[bool, str]]:
+    """
+    Run a list of conversions over each of a list of files, one after another
+    (see :func:`convert_file`).
+    Upcoming files are read in the background while the current one is converted.
+
+    Instead of being printed, each file's output is returned along with whether it
+    was/would be modified, so that output from files converted in parallel
+    can be printed in order without getting mixed together.
+    If a file fails to convert, :class:`ConversionFailed` is raised
+    (from the original error) so that the output so far isn't lost.
+    """
+    results: List[Tuple[bool, str]] = []
+    for file, contents in read_ahead(files):
+        out = io.StringIO()
+        try:
+            was_modified = convert_file(
+                file, conversions=conversions, dry_run=dry_run, contents=contents, out=out
+            )
+        except Exception as e:
+            raise ConversionFailed(file, results) from e
+
+        results.append((was_modified, out.getvalue()))
+
+    return results
+
+
+def read_ahead(files: Iterable[Path]) -> Iterator[Tuple[Path, bytes]]:
+    """
+    Yield each file along with its contents,
+    reading up to ``READ_AHEAD`` files ahead of the one most recently yielded.
+    """
+    with ThreadPoolExecutor(max_workers=READ_AHEAD) as executor:
+        pending: Deque[Tuple[Path, "Future[bytes]"]] = deque()
+        for file in files:
+            pending.append((file, executor.submit(file.read_bytes)))
+            if len(pending) > READ_AHEAD:
+                done, future = pending.popleft()
+                yield done, future.result()
+
+        for done, future in pending:
+            yield done, future.result()
+
+
+def diff(a: List[str], b: List[str], path: Path) -> Iterator[str]:
+    """
+    Lazily generate the lines of a unified diff between two versions of a file
+    (each given as a list of lines, with line endings),
+    so that they can be written out as they are produced.
+    """
+    for line in difflib.unified_diff(a, b, fromfile=str(path), tofile=f"un-fstring({path})"):
+        yield line
+
+        # Like diff and git, mark a last line that has no line ending
+        # (instead of running it into whatever gets written next).
+        if not line.endswith("\n"):
+            yield "\n\\ No newline at end of file\n"
 
 
 def gather_files(paths: Iterable[Path]) -> Iterator[Path]:
@@ -157,7 +401,18 @@ def gather_files(paths: Iterable[Path]) -> Iterator[Path]:
         if path.is_file() and path.suffix == ".py":
             yield path
         elif path.is_dir():
-            yield from gather_files(path.iterdir())
+            # os.walk is built on os.scandir, so it doesn't stat() every entry
+            # to tell files from directories; filter on the name before making Paths.
+            for root, dirs, names in os.walk(path, followlinks=True):
+                # Pruning dirs in-place stops os.walk from descending into them
+                dirs[:] = [d for d in dirs if d not in SKIP_DIRECTORIES]
+
+                for name in names:
+                    # Non-directories aren't necessarily regular files
+                    # (e.g., dangling symlinks like editor lock files, or FIFOs),
+                    # so only the entries that look like Python files get stat()ed.
+                    if name.endswith(".py") and os.path.isfile(os.path.join(root, name)):
+                        yield Path(root, name)
 
 
 def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
@@ -186,12 +441,47 @@ def cli() -> int:
 
     files = list(gather_files(args.path))
 
-    modified = [
-        convert_file(
-            file=file, conversions=[convert_f_strings_to_strings_format], dry_run=args.dry_run
-        )
-        for file in files
-    ]
+    conversions: List[Conversion] = [convert_f_strings]
+
+    modified = []
+    if len(files) < MIN_FILES_FOR_PARALLEL:
+        for file, contents in read_ahead(files):
+            modified.append(
+                convert_file(file, conversions=conversions, dry_run=args.dry_run, contents=contents)
+            )
+    else:
+        convert = functools.partial(convert_files, conversions=conversions, dry_run=args.dry_run)
+
+        # Each task is a batch of files, so that each worker can read ahead within its batch
+        batches = [files[i : i + FILES_PER_TASK] for i in range(0, len(files), FILES_PER_TASK)]
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(convert, batch) for batch in batches]
+
+            error: Optional[ConversionFailed] = None
+            for future in futures:
+                if future.cancelled():
+                    continue
+
+                try:
+                    results = future.result()
+                except ConversionFailed as e:
+                    results = e.results
+                    if error is None:
+                        error = e
+                        # Don't start any more batches,
+                        # but still report on the ones that are already running.
+                        for f in futures:
+                            f.cancel()
+
+                # Only this process writes each file's output, in file order,
+                # as soon as its batch is done, so that output from different files
+                # never gets mixed together.
+                for was_modified, output in results:
+                    sys.stdout.write(output)
+                    modified.append(was_modified)
+
+            if error is not None:
+                raise error
 
     if any(modified):
         if args.dry_run: